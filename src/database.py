@@ -1,37 +1,90 @@
 import os
-from typing import Any
+import threading
+from typing import Any, Callable, List, Optional, Tuple, TypeVar
 
 import pandas as pd
-import psycopg2
+from psycopg2 import InterfaceError, OperationalError
+from psycopg2.pool import ThreadedConnectionPool
 
 DBHOST = os.environ.get("DATABASE_HOST")
 DBDATABASE = os.environ.get("DATABASE_NAME")
 DBUSER = os.environ.get("DATABASE_USER")
 DBPASSWORD = os.environ.get("DATABASE_PASSWORD")
+# Keep (workers x PG_POOL_MAX) below the server's max_connections
+PG_POOL_MIN = int(os.environ.get("PG_POOL_MIN", 2))
+PG_POOL_MAX = int(os.environ.get("PG_POOL_MAX", 25))
 
+_POOL: Optional[ThreadedConnectionPool] = None
+_POOL_LOCK = threading.Lock()
 
-def connect() -> [Any, Any]:
-    # Set up a connection to the postgres server.
-    conn_string = f"host={DBHOST} port=5432 dbname={DBDATABASE} user={DBUSER} password={DBPASSWORD}"
-    conn = psycopg2.connect(conn_string)
-    cursor = conn.cursor()
-    return conn, cursor
+T = TypeVar("T")
+
+
+def get_pool() -> ThreadedConnectionPool:
+    # Created on first use so importing the module doesn't need a live database
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = ThreadedConnectionPool(
+                    minconn=PG_POOL_MIN,
+                    maxconn=PG_POOL_MAX,
+                    host=DBHOST,
+                    port=5432,
+                    dbname=DBDATABASE,
+                    user=DBUSER,
+                    password=DBPASSWORD,
+                )
+    return _POOL
+
+
+def connect() -> Any:
+    # Borrow a connection from the pool, hand it back with release()
+    return get_pool().getconn()
+
+
+def release(conn: Any, close: bool = False) -> None:
+    get_pool().putconn(conn, close=close)
+
+
+def _run_with_connection(work: Callable[[Any], T], idempotent: bool) -> T:
+    # Idle pooled connections can be dropped (e.g. while a Lambda is frozen), so a
+    # connection that turns out to be dead is discarded and the work retried once.
+    # Writes are only retried if they failed before COMMIT was sent, a dropped
+    # COMMIT may still have been applied by the server.
+    for attempt in range(2):
+        conn = connect()
+        committing = False
+        try:
+            # The connection block commits on success and rolls back on error
+            with conn:
+                result = work(conn)
+                committing = True
+            return result
+        except (OperationalError, InterfaceError):
+            if attempt or not conn.closed or (committing and not idempotent):
+                raise
+        finally:
+            release(conn, close=bool(conn.closed))
 
 
 def execute_pgsql(query: str):
-    conn, cursor = connect()
+    def execute(conn: Any) -> None:
+        with conn.cursor() as cursor:
+            cursor.execute(query)
+
     try:
-        cursor.execute(query)
-        conn.commit()
-        conn.close()
+        _run_with_connection(execute, idempotent=False)
     except Exception as e:
-        cursor.execute("rollback;")
-        conn.close()
-        raise ConnectionError(e)
+        raise ConnectionError(e) from e
 
 
 def get_pgsql_pandas_data(query: str):
-    conn, _ = connect()
-    data = pd.read_sql_query(query, conn)
-    conn.close()
-    return data
+    def fetch(conn: Any) -> Tuple[List[str], List[tuple]]:
+        with conn.cursor() as cursor:
+            cursor.execute(query)
+            return [column.name for column in cursor.description], cursor.fetchall()
+
+    columns, rows = _run_with_connection(fetch, idempotent=True)
+    # Same construction read_sql_query ends with, minus its DBAPI fallback layer
+    return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
@@ -1,3 +1,4 @@
+import atexit
 import base64
 import hashlib
 import hmac
@@ -5,11 +6,21 @@ import json
 import logging
 import os
 import re
-from functools import wraps
-from typing import Any, Dict, List, Optional, Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, wraps
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Union
+from urllib.parse import urlencode
 
 import requests
+import sentry_sdk
 from flask import abort, request
+from pythonjsonlogger import jsonlogger
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+if TYPE_CHECKING:
+    from redis import Redis
+    from rq import Queue
 
 logger = logging.getLogger(__name__)
 
@@ -21,18 +32,132 @@ INSTALL_REDIRECT_URL = f"{SERVER_BASE_URL}/app_installed"
 APP_NAME = os.environ.get("APP_NAME")
 SLACK_TOKEN = os.environ.get("SLACK_TOKEN")
 SLACK_DEFAULT_CHANNEL = os.environ.get("SLACK_DEFAULT_CHANNEL")
+REDIS_URL = os.environ.get("REDIS_URL")
+SENTRY_DSN = "https://3b9ea6a8c76e4ff997674020c6c596e2@o547884.ingest.sentry.io/5749865"
+# Shopify retries failed deliveries for up to 48 hours
+WEBHOOK_ID_TTL = 48 * 60 * 60
+# Shopify docs give regex with protocol required, but shop never includes protocol
+SHOPNAME_REGEX = re.compile(r"\A[a-zA-Z0-9][a-zA-Z0-9\-]*\.myshopify\.com/?\Z")
+SLACK_TIMEOUT = (3.05, 10)
 
+ACCESS_MODE = []  # Defaults to offline access mode if left blank or omitted.
+# https://shopify.dev/docs/admin-api/access-scopes
+SCOPES = [
+    "write_price_rules",
+    "write_script_tags",
+    "write_discounts",
+    "read_orders",
+    "read_products",
+    "read_customers",
+]
+# Everything in the install redirect except the per-request nonce
+INSTALL_REDIRECT_PARAMS = {
+    "client_id": SHOPIFY_API_KEY,
+    "scope": ",".join(SCOPES),
+    "redirect_uri": INSTALL_REDIRECT_URL,
+    "grant_options[]": ",".join(ACCESS_MODE),
+}
+
+
+def build_http_session(
+    pool_connections: int = 10,
+    pool_maxsize: int = 10,
+    max_retries: Union[int, Retry] = 0,
+) -> requests.Session:
+    # Long lived session so outbound calls reuse kept-alive TLS connections
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=max_retries,
+        ),
+    )
+    return session
+
+
+SLACK_SESSION = build_http_session(
+    pool_connections=4,
+    pool_maxsize=16,
+    # Connect retries only, a retried chat.postMessage could post twice
+    max_retries=Retry(total=2, connect=2, read=0, status=0),
+)
+
+# Fire-and-forget work (Slack posts) off the request.
+# Only useful under a long-lived server (gunicorn); on Lambda the process is
+# frozen once the response returns, so queued work may be delayed or lost.
+BACKGROUND_EXECUTOR = ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix="background"
+)
+atexit.register(BACKGROUND_EXECUTOR.shutdown, wait=True)
+
+
+def _log_background_failure(future: Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Background task failed", exc_info=future.exception())
+
+
+def submit_background(func: Callable, *args: Any) -> Future:
+    # Nobody waits on these futures, so failures are logged (and reach Sentry) here
+    future = BACKGROUND_EXECUTOR.submit(func, *args)
+    future.add_done_callback(_log_background_failure)
+    return future
+
+
+@lru_cache(maxsize=None)
+def get_redis() -> "Redis":
+    # Imported here so deployments without REDIS_URL never load redis/rq
+    from redis import Redis
+
+    return Redis.from_url(REDIS_URL)
+
+
+@lru_cache(maxsize=None)
+def get_task_queue() -> "Queue":
+    from rq import Queue
+
+    return Queue(connection=get_redis())
+
+
+def enqueue_task(func: Callable, *args: Any) -> None:
+    # Runs on an RQ worker, callers check REDIS_URL is configured first
+    get_task_queue().enqueue(func, *args)
 
-def generate_install_redirect_url(
-    shop: str, scopes: List, nonce: str, access_mode: List
-):
-    scopes_string = ",".join(scopes)
-    access_mode_string = ",".join(access_mode)
-    redirect_url = f"https://{shop}/admin/oauth/authorize?client_id={SHOPIFY_API_KEY}&scope={scopes_string}&redirect_uri={INSTALL_REDIRECT_URL}&state={nonce}&grant_options[]={access_mode_string}"  # noqa: E501
-    logger.info(f"New shop installing {shop}")
-    logger.info("redirect_url: ")
-    logger.info(redirect_url)
-    return redirect_url
+
+def is_new_webhook(webhook_id: Optional[str]) -> bool:
+    # Records the delivery as seen, without Redis there's nowhere shared to do so
+    if not REDIS_URL or webhook_id is None:
+        return True
+    return bool(
+        get_redis().set(
+            f"shopify_webhook:{webhook_id}", 1, nx=True, ex=WEBHOOK_ID_TTL
+        )
+    )
+
+
+def forget_webhook(webhook_id: Optional[str]) -> None:
+    # Undo is_new_webhook when handling failed, so Shopify's redelivery is processed
+    if REDIS_URL and webhook_id is not None:
+        get_redis().delete(f"shopify_webhook:{webhook_id}")
+
+
+def configure_json_logging() -> None:
+    # Structured records so extra= fields stay queryable rather than inlined
+    root_logger = logging.getLogger()
+    if not root_logger.handlers:
+        root_logger.addHandler(logging.StreamHandler())
+    formatter = jsonlogger.JsonFormatter(
+        "%(asctime)s %(levelname)s %(name)s %(message)s"
+    )
+    for handler in root_logger.handlers:
+        handler.setFormatter(formatter)
+
+
+def generate_install_redirect_url(shop: str, nonce: str):
+    logger.info("New shop installing %s", shop)
+    query = urlencode({**INSTALL_REDIRECT_PARAMS, "state": nonce})
+    return f"https://{shop}/admin/oauth/authorize?{query}"
 
 
 def generate_post_install_redirect_url(shop: str):
@@ -45,9 +170,12 @@ def verify_web_call(f):
     def wrapper(*args, **kwargs) -> bool:
         get_args = request.args
         hmac_value = get_args.get("hmac")
-        sorted(get_args)
         data = "&".join(
-            [f"{key}={value}" for key, value in get_args.items() if key != "hmac"]
+            sorted(
+                signed_query_pair(key, values)
+                for key, values in get_args.lists()
+                if key != "hmac"
+            )
         ).encode("utf-8")
         if not verify_hmac(data, hmac_value):
             logger.error(
@@ -64,16 +192,28 @@ def verify_web_call(f):
     return wrapper
 
 
+def signed_query_pair(key: str, values: List[str]) -> str:
+    # Shopify signs pairs raw, escaping only % and = in keys and % in values, then &
+    if key.endswith("[]"):
+        # Array params are signed as key=["a", "b"]
+        key, value = key[:-2], json.dumps(values)
+    else:
+        value = values[0]
+    key = key.replace("%", "%25").replace("=", "%3D")
+    value = value.replace("%", "%25")
+    return f"{key}={value}".replace("&", "%26")
+
+
 def verify_webhook_call(f):
     @wraps(f)
     def wrapper(*args, **kwargs) -> bool:
         encoded_hmac = request.headers.get("X-Shopify-Hmac-Sha256")
-        hmac_value = base64.b64decode(encoded_hmac).hex()
+        hmac_value = base64.b64decode(encoded_hmac or "")
 
         data = request.get_data()
-        if not verify_hmac(data, hmac_value):
+        if not verify_hmac_raw(data, hmac_value):
             logger.error(
-                f"HMAC could not be verified: \n\thmac {hmac_value}\n\tdata {data}"
+                f"HMAC could not be verified: \n\thmac {encoded_hmac}\n\tdata {data}"
             )
             abort(401)
         return f(*args, **kwargs)
@@ -81,15 +221,29 @@ def verify_webhook_call(f):
     return wrapper
 
 
+@lru_cache(maxsize=None)
+def _hmac_template() -> hmac.HMAC:
+    # Keyed once, each verification copies the already keyed inner/outer state
+    return hmac.new(SHOPIFY_API_SECRET.encode("utf-8"), None, hashlib.sha256)
+
+
 def verify_hmac(data: bytes, orig_hmac: str):
-    new_hmac = hmac.new(SHOPIFY_API_SECRET.encode("utf-8"), data, hashlib.sha256)
-    return new_hmac.hexdigest() == orig_hmac
+    new_hmac = _hmac_template().copy()
+    new_hmac.update(data)
+    # Bytes, str compare_digest raises on non-ASCII input instead of returning False
+    return hmac.compare_digest(
+        new_hmac.hexdigest().encode("utf-8"), (orig_hmac or "").encode("utf-8")
+    )
+
+
+def verify_hmac_raw(data: bytes, orig_hmac: bytes):
+    new_hmac = _hmac_template().copy()
+    new_hmac.update(data)
+    return hmac.compare_digest(new_hmac.digest(), orig_hmac)
 
 
 def is_valid_shop(shop: str) -> bool:
-    # Shopify docs give regex with protocol required, but shop never includes protocol
-    shopname_regex = r"[a-zA-Z0-9][a-zA-Z0-9\-]*\.myshopify\.com[\/]?"
-    return re.match(shopname_regex, shop)
+    return SHOPNAME_REGEX.match(shop) is not None
 
 
 def webhook_fail(
@@ -101,16 +255,19 @@ def webhook_fail(
         f"Shop {webhook_payload.get('domain')} couldn't be found or isn't installed"
     )
     error_str = error_str or default_err_str
-    logger.error(error_str)
+    sentry_sdk.set_context(
+        "webhook", {"topic": webhook_topic, "payload": webhook_payload}
+    )
+    # Payload is serialized once, by the JSON log formatter
     logger.error(
-        f"Webhook topic: {webhook_topic}:\n{json.dumps(webhook_payload, indent=4)}"
+        error_str, extra={"topic": webhook_topic, "payload": webhook_payload}
     )
     return error_str
 
 
 def post_message_to_slack(text: str, channel: Optional[str] = None, blocks: Any = None):
     logger.info("posting to slack")
-    response = requests.post(
+    response = SLACK_SESSION.post(
         "https://slack.com/api/chat.postMessage",
         {
             "token": SLACK_TOKEN,
@@ -121,6 +278,7 @@ def post_message_to_slack(text: str, channel: Optional[str] = None, blocks: Any
             "username": "ShopifyApp",
             "blocks": json.dumps(blocks) if blocks else None,
         },
+        timeout=SLACK_TIMEOUT,
     ).json()
     logger.info(response)
     return response
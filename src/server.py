@@ -1,25 +1,32 @@
-import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, Tuple, Union
 
+import orjson
 import sentry_sdk
-from flask import Flask, redirect, request
+from flask import Flask, abort, g, redirect, request
 from sentry_sdk.integrations.flask import FlaskIntegration
 
 from .client_app import client_side_app
-from .helpers import (SERVER_BASE_URL, generate_install_redirect_url,
-                      generate_post_install_redirect_url,
-                      post_message_to_slack, verify_web_call,
-                      verify_webhook_call, webhook_fail)
+from .helpers import (REDIS_URL, SENTRY_DSN, SERVER_BASE_URL,
+                      configure_json_logging, enqueue_task, forget_webhook,
+                      generate_install_redirect_url,
+                      generate_post_install_redirect_url, is_new_webhook,
+                      post_message_to_slack, submit_background,
+                      verify_web_call, verify_webhook_call, webhook_fail)
 from .shopify_client import PGStoreInterface, ShopifyStoreClient, StoreStatus
 from .shopify_interpreter import create_prds_on_shopify, find_discount
-from .shopify_munging import process_order
+from .shopify_munging import process_order, process_order_for_shop
 
 logger = logging.getLogger(__name__)
+configure_json_logging()
 sentry_sdk.init(
-    dsn="https://3b9ea6a8c76e4ff997674020c6c596e2@o547884.ingest.sentry.io/5749865",
+    dsn=SENTRY_DSN,
     integrations=[FlaskIntegration()],
+    # Auto-enabled integrations import every supported library that's installed,
+    # including redis/rq, which the web process only needs when REDIS_URL is set
+    auto_enabling_integrations=False,
     # Set traces_sample_rate to 1.0 to capture 100%
     # of transactions for performance monitoring.
     # We recommend adjusting this value in production.
@@ -28,28 +35,25 @@ sentry_sdk.init(
 
 app = Flask(__name__)
 
-ACCESS_MODE = []  # Defaults to offline access mode if left blank or omitted.
-# https://shopify.dev/docs/admin-api/access-scopes
-SCOPES = [
-    "write_price_rules",
-    "write_script_tags",
-    "write_discounts",
-    "read_orders",
-    "read_products",
-    "read_customers",
-]
 WEBHOOKS = {
-    "app/uninstalled": f"{SERVER_BASE_URL}/app_uninstalled",
-    "orders/create": f"{SERVER_BASE_URL}/order_created",
-    "refunds/create": f"{SERVER_BASE_URL}/refund_created",
-    # "customers/redact": f"{SERVER_BASE_URL}/redact_customers",
-    # "shop/redact": f"{SERVER_BASE_URL}/redact_shop",
-    # "customers/data_request": f"{SERVER_BASE_URL}/customers_data_request",
+    "app/uninstalled": f"{SERVER_BASE_URL}/webhook/app_uninstalled",
+    "orders/create": f"{SERVER_BASE_URL}/webhook/order_created",
+    "refunds/create": f"{SERVER_BASE_URL}/webhook/refund_created",
+    # "customers/redact": f"{SERVER_BASE_URL}/webhook/redact_customers",
+    # "shop/redact": f"{SERVER_BASE_URL}/webhook/redact_shop",
+    # "customers/data_request": f"{SERVER_BASE_URL}/webhook/customers_data_request",
 }
 # https://shopify.dev/tutorials/add-gdpr-webhooks-to-your-app#customers-data_request
 
 
-@app.route("/", methods=["GET"])
+def get_store_db_interface(shop: str) -> PGStoreInterface:
+    # One PGStoreInterface (and its lookup query) per shop per request
+    store_db_interfaces = g.setdefault("store_db_interfaces", {})
+    if shop not in store_db_interfaces:
+        store_db_interfaces[shop] = PGStoreInterface(shop=shop)
+    return store_db_interfaces[shop]
+
+
 def landing():
     return """
     <h1>Gooie Shopify App</h1>
@@ -58,13 +62,12 @@ def landing():
     """
 
 
-@app.route("/app_launched", methods=["GET"])
-@verify_web_call
 def app_launched():
     logger.info("app_launched hit")
-    logger.info(request.get_json())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("payload=%r", request.get_json())
     shop = request.args.get("shop")
-    store_db_interface = PGStoreInterface(shop=shop)
+    store_db_interface = get_store_db_interface(shop)
     shop_status = store_db_interface.status
 
     if shop_status == StoreStatus.NOT_KNOWN:
@@ -86,21 +89,18 @@ def app_launched():
         )
 
     nonce = store_db_interface.data["nonce"]
-    redirect_url = generate_install_redirect_url(
-        shop=shop, scopes=SCOPES, nonce=nonce, access_mode=ACCESS_MODE
-    )
+    redirect_url = generate_install_redirect_url(shop=shop, nonce=nonce)
     return redirect(redirect_url, code=302)
 
 
-@app.route("/app_installed", methods=["GET"])
-@verify_web_call
 def app_installed():
     logger.info("app_installed hit")
-    logger.info(request.get_json())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("payload=%r", request.get_json())
     state = request.args.get("state")
     shop = request.args.get("shop")
     code = request.args.get("code")
-    store_db_interface = PGStoreInterface(shop=shop)
+    store_db_interface = get_store_db_interface(shop)
 
     if store_db_interface.status != StoreStatus.INSTALL_REQUESTED:
         return (
@@ -117,19 +117,30 @@ def app_installed():
 
     ACCESS_TOKEN = ShopifyStoreClient.authenticate(shop=shop, code=code)
     store_db_interface.confirm_installation(ACCESS_TOKEN)
-    post_message_to_slack(
-        f"""
-        App Installed for {store_db_interface.shop}
-    """
-    )
     shopify_client = ShopifyStoreClient(shop=shop, access_token=ACCESS_TOKEN)
 
-    _ = [
-        shopify_client.create_webook(address, topic)
-        for topic, address in WEBHOOKS.items()
-    ]
+    # Slack, webhook creation and RAC creation are independent network calls
+    with ThreadPoolExecutor(max_workers=len(WEBHOOKS) + 1) as executor:
+        slack_future = executor.submit(
+            post_message_to_slack,
+            f"""
+        App Installed for {store_db_interface.shop}
+    """,
+        )
+        webhook_futures = [
+            executor.submit(shopify_client.create_webook, address, topic)
+            for topic, address in WEBHOOKS.items()
+        ]
+        rac_response = shopify_client.create_recurring_application_charges()
+
+    if slack_future.exception() is not None:
+        logger.error(
+            "Install Slack notification failed", exc_info=slack_future.exception()
+        )
+    # Surface webhook creation errors as they were before being parallelized
+    for webhook_future in webhook_futures:
+        webhook_future.result()
 
-    rac_response = shopify_client.create_recurring_application_charges()
     if rac_response is None:
         logger.error("RAC didnt return a response, can't set rac_id")
     else:
@@ -147,19 +158,24 @@ def app_installed():
 def handle_webhook(
     request: Any, webhook_name: str
 ) -> Union[str, Tuple[str, Dict, PGStoreInterface]]:
-    logger.info(f"{webhook_name} hit")
+    logger.info("%s hit", webhook_name)
     webhook_topic = request.headers.get("X-Shopify-Topic")
-    webhook_payload = request.get_json()
+    try:
+        webhook_payload = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        logger.error("%s received a body that isn't valid JSON", webhook_name)
+        abort(400)
     shop_address = request.headers.get("X-Shopify-Shop-Domain") or webhook_payload.get(
         "domain"
     )
-    logger.info(request.get_json())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("payload=%r", webhook_payload)
 
     if shop_address is None:
         return webhook_fail(
             webhook_topic, webhook_payload, error_str="No shop found in header"
         )
-    store_db_interface = PGStoreInterface(shop=shop_address)
+    store_db_interface = get_store_db_interface(shop_address)
     if not store_db_interface.status == StoreStatus.INSTALLED:
         error_str = f"Shopify Store {shop_address} not installed. Status: {store_db_interface.status}"
         return webhook_fail(webhook_topic, webhook_payload, error_str=error_str)
@@ -167,117 +183,69 @@ def handle_webhook(
     return webhook_topic, webhook_payload, store_db_interface
 
 
-@app.route("/app_uninstalled", methods=["POST"])
-@verify_webhook_call
-def app_uninstalled():
-    webhook_values = handle_webhook(request, "app_uninstalled")
-    if isinstance(webhook_values, str):
-        return webhook_values
-    webhook_topic, webhook_payload, sDBI = webhook_values
-
+def uninstall_webhook(sDBI: PGStoreInterface, webhook_payload: Dict) -> str:
     logger.info(f"Uninstalling {sDBI.shop}")
     sDBI.uninstall()
     logger.info("Uninstall Successful")
-
-    post_message_to_slack(
-        f"""
-        App uninstalled @ {sDBI.shop}
-    """
-    )
     return f"Gooie App uninstalled for {sDBI.shop}"
 
 
-@app.route("/redact_customers", methods=["POST"])
-@verify_webhook_call
-def redact_customers():
-    webhook_values = handle_webhook(request, "redact_customers")
-    if isinstance(webhook_values, str):
-        return webhook_values
-    webhook_topic, webhook_payload, sDBI = webhook_values
-
-    post_message_to_slack(
-        f"""
-        redact_customers @ {sDBI.shop}:\n{json.dumps(webhook_payload, indent=4)}
-    """
-    )
-
-    return "OK"
-
-
-@app.route("/redact_shop", methods=["POST"])
-@verify_webhook_call
-def redact_shop():
-    webhook_values = handle_webhook(request, "redact_shop")
-    if isinstance(webhook_values, str):
-        return webhook_values
-    webhook_topic, webhook_payload, sDBI = webhook_values
-
-    post_message_to_slack(
-        f"""
-        redact_shop @ {sDBI.shop}:\n{json.dumps(webhook_payload, indent=4)}
-    """
-    )
-
+def order_webhook(sDBI: PGStoreInterface, order: Dict) -> str:
+    if REDIS_URL:
+        enqueue_task(process_order_for_shop, sDBI.shop, order)
+    else:
+        # No queue to hand off to, process inline so failures still fail the webhook
+        process_order(sDBI, order)
     return "OK"
 
 
-@app.route("/customers_data_request", methods=["POST"])
-@verify_webhook_call
-def customers_data_request():
-    webhook_values = handle_webhook(request, "customers_data_request")
-    if isinstance(webhook_values, str):
-        return webhook_values
-    webhook_topic, webhook_payload, sDBI = webhook_values
-
-    post_message_to_slack(
-        f"""
-        customers_data_request @ {sDBI.shop}:\n{json.dumps(webhook_payload, indent=4)}
-    """
-    )
+def acknowledge_webhook(sDBI: PGStoreInterface, webhook_payload: Dict) -> str:
     return "OK"
 
 
-@app.route("/order_created", methods=["POST"])
-@verify_webhook_call
-def order_created():
-    webhook_values = handle_webhook(request, "order_created")
-    if isinstance(webhook_values, str):
-        return webhook_values
-    webhook_topic, order, sDBI = webhook_values
-    post_message_to_slack(
-        f"""
-        order_created @ {sDBI.shop}:\n{json.dumps(order, indent=4)}
-    """,
-        "#new_orders",
-    )
-    process_order(sDBI, order)
-    return "OK"
+# webhook name: (slack channel, include payload in slack message, handler)
+WEBHOOK_HANDLERS = {
+    "app_uninstalled": (None, False, uninstall_webhook),
+    "redact_customers": (None, True, acknowledge_webhook),
+    "redact_shop": (None, True, acknowledge_webhook),
+    "customers_data_request": (None, True, acknowledge_webhook),
+    "order_created": ("#new_orders", True, order_webhook),
+    "refund_created": ("#new_refunds", True, acknowledge_webhook),
+}
 
 
-@app.route("/refund_created", methods=["POST"])
-@verify_webhook_call
-def refund_created():
-    webhook_values = handle_webhook(request, "refund_created")
+def shopify_webhook(name: str):
+    if name not in WEBHOOK_HANDLERS:
+        abort(404)
+    webhook_values = handle_webhook(request, name)
     if isinstance(webhook_values, str):
         return webhook_values
     webhook_topic, webhook_payload, sDBI = webhook_values
-    post_message_to_slack(
-        f"""
-        refund_created @ {sDBI.shop}:\n{json.dumps(webhook_payload, indent=4)}
-    """,
-        "#new_refunds",
-    )
-    return "OK"
+
+    webhook_id = request.headers.get("X-Shopify-Webhook-Id")
+    if not is_new_webhook(webhook_id):
+        logger.info("Skipping redelivered webhook %s", webhook_id)
+        return "OK"
+
+    channel, post_payload, handler = WEBHOOK_HANDLERS[name]
+    try:
+        response = handler(sDBI, webhook_payload)
+    except Exception:
+        forget_webhook(webhook_id)
+        raise
+    # Notify only once the handler has succeeded
+    slack_text = f"{name} @ {sDBI.shop}"
+    if post_payload:
+        slack_text += f":\n{orjson.dumps(webhook_payload, option=orjson.OPT_INDENT_2).decode()}"
+    submit_background(post_message_to_slack, slack_text, channel)
+    return response
 
 
-@app.route("/create_discount", methods=["GET"])
 def create_discount():
     logger.info("/create_discount hit")
-    logger.info(request.headers)
-    logger.info(request.json())
-    logger.info(request.__dict__)
     request_args = request.get_json()
-    logger.info(request_args)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("payload=%r", request_args)
     discount_code = request_args.get("discount_name")
     prd_obj = find_discount(discount_code)
     if prd_obj is None:
@@ -286,7 +254,29 @@ def create_discount():
     return "OK"
 
 
+verified_shopify_webhook = verify_webhook_call(shopify_webhook)
+# (rule, view, methods, endpoint), added together so the url map is built once
+ROUTES = [
+    ("/", landing, ["GET"], None),
+    ("/app_launched", verify_web_call(app_launched), ["GET"], None),
+    ("/app_installed", verify_web_call(app_installed), ["GET"], None),
+    ("/webhook/<name>", verified_shopify_webhook, ["POST"], None),
+    # Pre-existing subscriptions and Partner portal GDPR URLs still use the bare paths
+    (
+        f"/<any({', '.join(WEBHOOK_HANDLERS)}):name>",
+        verified_shopify_webhook,
+        ["POST"],
+        "legacy_shopify_webhook",
+    ),
+    ("/create_discount", create_discount, ["GET"], None),
+]
+for rule, view_func, methods, endpoint in ROUTES:
+    app.add_url_rule(rule, endpoint=endpoint, view_func=view_func, methods=methods)
+app.url_map.update()
+
+
 if __name__ == "__main__":
     # Bind to PORT if defined, otherwise default to 5000.
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+    # Local debugging only, deploy through wsgi.py behind gunicorn
+    app.run(host="0.0.0.0", port=port, debug=False, use_reloader=False)
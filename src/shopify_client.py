@@ -6,10 +6,10 @@ from enum import Enum
 from typing import Dict, List, Optional
 
 import pandas as pd
-import requests
 from requests.exceptions import HTTPError
 
 from .database import execute_pgsql, get_pgsql_pandas_data
+from .helpers import build_http_session
 
 logger = logging.getLogger(__name__)
 
@@ -18,11 +18,13 @@ SHOPIFY_API_KEY = os.environ.get("SHOPIFY_API_KEY")
 POST_RECURRING_CHARGE_URL = os.environ.get("POST_RECURRING_CHARGE_URL")
 SHOPIFY_API_VERSION = "2021-04"
 
+SHOPIFY_SESSION = build_http_session()
+SHOPIFY_TIMEOUT = (3.05, 10)
 REQUEST_METHODS = {
-    "GET": requests.get,
-    "POST": requests.post,
-    "PUT": requests.put,
-    "DEL": requests.delete,
+    "GET": SHOPIFY_SESSION.get,
+    "POST": SHOPIFY_SESSION.post,
+    "PUT": SHOPIFY_SESSION.put,
+    "DEL": SHOPIFY_SESSION.delete,
 }
 
 
@@ -59,7 +61,7 @@ class ShopifyStoreClient:
             "code": code,
         }
         try:
-            response = requests.post(url, json=payload)
+            response = SHOPIFY_SESSION.post(url, json=payload, timeout=SHOPIFY_TIMEOUT)
             response.raise_for_status()
             return response.json()["access_token"]
         except HTTPError as ex:
@@ -72,13 +74,20 @@ class ShopifyStoreClient:
         method: str,
         params: dict = None,
         payload: dict = None,
-        headers: dict = {},
+        headers: Optional[dict] = None,
     ) -> Optional[dict]:
         url = f"{self.base_url}{call_path}"
         request_func = REQUEST_METHODS[method]
-        headers["X-Shopify-Access-Token"] = self.access_token
+        # Copy rather than mutate, calls may run concurrently from several threads
+        headers = {**(headers or {}), "X-Shopify-Access-Token": self.access_token}
         try:
-            response = request_func(url, params=params, json=payload, headers=headers)
+            response = request_func(
+                url,
+                params=params,
+                json=payload,
+                headers=headers,
+                timeout=SHOPIFY_TIMEOUT,
+            )
             response.raise_for_status()
             if response.content:
                 logger.debug(
@@ -402,3 +402,8 @@ def process_order(sDBI, order):
     }
     if len(possible_discount_matches) > 0:
         handle_matched_discount(order, business, sDBI, possible_discount_matches)
+
+
+def process_order_for_shop(shop: str, order: Dict) -> None:
+    # Queue entrypoint, workers look the store up again rather than pickling it
+    process_order(PGStoreInterface(shop=shop), order)
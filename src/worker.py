@@ -0,0 +1,23 @@
+import logging
+
+import sentry_sdk
+from rq import Worker
+from sentry_sdk.integrations.rq import RqIntegration
+
+from .helpers import SENTRY_DSN, configure_json_logging, get_redis, get_task_queue
+
+
+def main():
+    # The worker never imports server.py, so it sets up logging and Sentry itself
+    configure_json_logging()
+    logging.getLogger().setLevel(logging.INFO)
+    sentry_sdk.init(
+        dsn=SENTRY_DSN,
+        integrations=[RqIntegration()],
+        traces_sample_rate=1.0,
+    )
+    Worker([get_task_queue()], connection=get_redis()).work()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+from src.server import app as application